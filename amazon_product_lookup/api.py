@@ -3,13 +3,13 @@
 # Amazon Example - http://docs.aws.amazon.com/AWSECommerceService/latest/DG/rest-signature.html
 import urllib.parse
 import hmac
-import hashlib
 import base64
 import time
+import concurrent.futures
 import requests.adapters
 import json
 import xmltodict
-import collections
+from functools import cached_property
 
 
 # TODO add 'SimilarityLookup' - http://docs.aws.amazon.com/AWSECommerceService/latest/DG/SimilarityLookup.html
@@ -30,16 +30,56 @@ class APIReturnError(WrapperException):
     pass
 
 
+def _safe_quote(value, _quote=urllib.parse.quote_plus):
+    # ASCII letters and digits never need encoding, so skip quote_plus for them. isalnum() alone is not enough as it
+    # is also True for non-ASCII letters
+    if value.isascii() and value.isalnum():
+        return value
+    return _quote(value)
+
+
+def _build_signed_url(endpoint, sign_prefix, secret_key_bytes, query, keys):
+    # Pure signing step, kept free of any AmazonAPI state so it can be swapped for a compiled version.
+    # query values must already be URL encoded and keys must be sorted by byte value (alphabetical but capitals first)
+    query_str = '&'.join(key + '=' + query[key] for key in keys)
+
+    # Create the hash signature. The signed data is NOT used for the actual request
+    dig = hmac.digest(secret_key_bytes, sign_prefix + query_str.encode('latin-1'), 'sha256')
+    # Base64 output only needs '+', '/' and '=' percent encoded
+    sig = base64.b64encode(dig).decode('ascii').replace('+', '%2B').replace('/', '%2F').replace('=', '%3D')
+
+    # Add the signature at the end of the query string
+    return endpoint + query_str + '&Signature=' + sig
+
+
 class AmazonAPI:
     def __init__(self, access_key, secret_access_key, associate_id, query_rate=1.1, request_timeout=3, request_retries=3):
+        self.version = '2013-08-01'
+        # Parameters that are the same for every lookup are URL encoded once. The credential properties below keep
+        # this (and the encoded secret key) in sync if they are reassigned
+        self._base_query_encoded = {'Service': 'AWSECommerceService',
+                                    'Operation': 'ItemLookup',
+                                    'Version': self.version}
+        self._sign_prefix = b'GET\nwebservices.amazon.com\n/onca/xml\n'
         self.access_key = access_key
         self.secret_access_key = secret_access_key
         self.associate_id = associate_id
+        # Only MerchantId is optional, so there are just two possible canonical key orders. Sort them once
+        query_keys = list(self._base_query_encoded) + ['ItemId', 'ResponseGroup', 'Timestamp', 'Condition',
+                                                       'IncludeReviewsSummary', 'IdType']
+        self._sorted_keys_no_merchant = tuple(sorted(query_keys))
+        self._sorted_keys_with_merchant = tuple(sorted(query_keys + ['MerchantId']))
         self.endpoint = 'http://webservices.amazon.com/onca/xml?'
-        self.version = '2013-08-01'
         self.query_rate = query_rate
         self.request_timeout = request_timeout
         self.request_retries = request_retries
+        # Keep a single session so repeated lookups reuse pooled keep-alive connections
+        # The pool size also caps the number of workers lookup_many() can use
+        self._pool_maxsize = 10
+        self._session = requests.Session()
+        self._session.mount('http://', requests.adapters.HTTPAdapter(max_retries=self.request_retries,
+                                                                     pool_connections=4,
+                                                                     pool_maxsize=self._pool_maxsize))
         self.response_groups = ['Request', 'ItemIds', 'Small', 'Medium', 'Large', 'Offers', 'OfferFull', 'OfferSummary',
                                 'OfferListings', 'PromotionSummary', 'PromotionDetails', 'Variations',
                                 'VariationImages', 'VariationMinimum', 'VariationSummary', 'TagsSummary', 'Tags',
@@ -53,6 +93,37 @@ class AmazonAPI:
         # ItemIds: Only returns 'ASIN' and 'ParentASIN'
         # Small: ASIN, DetailPageURL, ItemLinks, ItemAttributes
 
+    @property
+    def access_key(self):
+        return self._access_key
+
+    @access_key.setter
+    def access_key(self, value):
+        self._access_key = value
+        self._base_query_encoded['AWSAccessKeyId'] = urllib.parse.quote_plus(value)
+
+    @property
+    def secret_access_key(self):
+        return self._secret_access_key
+
+    @secret_access_key.setter
+    def secret_access_key(self, value):
+        self._secret_access_key = value
+        self._secret_key_bytes = value.encode('latin-1')
+
+    @property
+    def associate_id(self):
+        return self._associate_id
+
+    @associate_id.setter
+    def associate_id(self, value):
+        self._associate_id = value
+        self._base_query_encoded['AssociateTag'] = urllib.parse.quote_plus(value)
+
+    def get_session(self):
+        # Exposed so callers can mount their own adapters (eg., custom retry/backoff policies)
+        return self._session
+
     def lookup(self, item_id, id_type, response_group=('Large',), condition='New', include_reviews_summary=True,
                merchant_id='All'):
         # TODO Add exception if IdType is not valid
@@ -69,14 +140,9 @@ class AmazonAPI:
         response_group = ','.join(response_group)
         item_ids = ','.join(item_id)
         timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-        query = {'Service': 'AWSECommerceService',
-                 'AWSAccessKeyId': self.access_key,
-                 'Operation': 'ItemLookup',
-                 'ItemId': item_ids,
+        query = {'ItemId': item_ids,
                  'ResponseGroup': response_group,
-                 'Version': '2013-08-01',
                  'Timestamp': timestamp,
-                 'AssociateTag': self.associate_id,
                  'Condition': condition,
                  'IncludeReviewsSummary': str(include_reviews_summary),
                  'IdType': id_type}
@@ -85,36 +151,20 @@ class AmazonAPI:
         if merchant_id == 'Amazon':
             query['MerchantId'] = merchant_id
 
-        # URL encode each parameter to remove special characters
-        for key in query:
-            query[key] = urllib.parse.quote_plus(query[key])
-
-        # Create the query string. Values must be sorted by byte value (alphabetical but capitals first)
-        # TODO make this not so ugly. Got to be a better way
-        query_str = ''
-        for key in sorted(query):
-            query_str = query_str + '&' + key + '=' + query[key]
-        query_str = query_str[1:]
-
-        # Create the URL for creating the hash. This is NOT used for the actual request
-        data = 'GET\nwebservices.amazon.com\n/onca/xml\n' + query_str
+        # URL encode each per-call parameter to remove special characters, then add the pre-encoded ones
+        query = {key: _safe_quote(value) for key, value in query.items()}
+        query.update(self._base_query_encoded)
 
-        # Create the hash signature
-        dig = hmac.new(bytes(self.secret_access_key, 'latin-1'), bytes(data, 'latin-1'), hashlib.sha256).digest()
-        sig = base64.b64encode(dig).decode()
-        sig = urllib.parse.quote_plus(sig)
-
-        # Add the signature at the end of the query string
-        query_str = query_str + '&Signature=' + sig
-        request_url = self.endpoint + query_str
+        keys = self._sorted_keys_with_merchant if merchant_id == 'Amazon' else self._sorted_keys_no_merchant
+        request_url = _build_signed_url(self.endpoint, self._sign_prefix, self._secret_key_bytes, query, keys)
 
         # Make the request
-        s = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=self.request_retries)
-        s.mount('http://', adapter)
-        r = s.get(request_url, timeout=self.request_timeout)
-        r_str = r.content.decode('utf-8')
-        response = xmltodict.parse(r_str)
+        r = self._session.get(request_url, timeout=self.request_timeout)
+        # Fail early on HTTP errors (eg., throttling) rather than parsing an error page as a lookup response
+        if r.status_code >= 400:
+            raise APIReturnError('HTTP {0}: {1}'.format(r.status_code, r.text[:500]))
+        # Parse the raw bytes. The XML declaration specifies the encoding so there is no need to decode first
+        response = xmltodict.parse(r.content, dict_constructor=dict)
 
         # Determine if the response is valid. If not, raise exception
         valid = response['ItemLookupResponse']['Items']['Request']['IsValid']
@@ -131,22 +181,34 @@ class AmazonAPI:
 
         # Response is a dict if only one item and a list of dicts if multiple items
         # print(json.dumps(products, indent=2))
-        if isinstance(products, collections.OrderedDict):
+        if isinstance(products, dict):
             return [AmazonItem(products)]
         elif isinstance(products, list):
             return [AmazonItem(_item) for _item in products]
         else:
             raise APIReturnError('Unknown response type')
 
+    def lookup_many(self, item_ids, chunk=10, max_workers=4, **kwargs):
+        # Splits item_ids into lookups of up to 10 items (Amazon's limit) and runs them concurrently over the shared
+        # session. kwargs are passed to lookup(). Items are returned in the same order as item_ids
+        if not 1 <= chunk <= 10:
+            raise APICallError('chunk must be between 1 and 10.')
+        if not 1 <= max_workers <= self._pool_maxsize:
+            raise APICallError('max_workers must be between 1 and {0}.'.format(self._pool_maxsize))
+        # A bare string would otherwise be split into single character item ids
+        if isinstance(item_ids, str):
+            raise APICallError('item_ids must be a sequence of item ids, not "str"')
+        item_ids = tuple(item_ids)
+        chunks = [item_ids[i:i + chunk] for i in range(0, len(item_ids), chunk)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+            results = list(ex.map(lambda c: self.lookup(c, **kwargs), chunks))
+        return [_item for result in results for _item in result]
+
 
 class AmazonItem:
     def __init__(self, response):
         self._response = response
         # print(json.dumps(self._response, indent=4))
-        self.item_attributes = ItemAttributes(self._response.get('ItemAttributes', {}))
-        self.offer_summary = OfferSummary(self._response.get('OfferSummary', {}))
-        self.offers = Offers(self._response.get('Offers', {}))
-        self.item_links = Links(self._response.get('ItemLinks', {}))
 
     def __repr__(self):
         return 'ASIN: {0}'.format(self.asin)
@@ -155,6 +217,23 @@ class AmazonItem:
         print(json.dumps(self._response, indent=indent))
         return None
 
+    # The wrappers are only built the first time one of their properties is accessed
+    @cached_property
+    def item_attributes(self):
+        return ItemAttributes(self._response.get('ItemAttributes', {}))
+
+    @cached_property
+    def offer_summary(self):
+        return OfferSummary(self._response.get('OfferSummary', {}))
+
+    @cached_property
+    def offers(self):
+        return Offers(self._response.get('Offers', {}))
+
+    @cached_property
+    def item_links(self):
+        return Links(self._response.get('ItemLinks', {}))
+
     @property
     def asin(self):
         return self._response.get('ASIN')
@@ -302,15 +381,17 @@ class AmazonItem:
 
 class Links:
     def __init__(self, item_links):
-        self._item_links = item_links.get('ItemLink', {})
-        try:
-            self.description_url = next(x['URL'] for x in self._item_links if x['Description'] == 'Technical Details')
-        except StopIteration:
-            self.description_url = None
-        try:
-            self.all_offers_url = next(x['URL'] for x in self._item_links if x['Description'] == 'All Offers')
-        except StopIteration:
-            self.all_offers_url = None
+        self._item_links = item_links.get('ItemLink', [])
+        # A single link is returned as a dict rather than a list of dicts
+        if not isinstance(self._item_links, list):
+            self._item_links = [self._item_links]
+        self.description_url = self.all_offers_url = None
+        for x in self._item_links:
+            description = x.get('Description')
+            if description == 'Technical Details' and self.description_url is None:
+                self.description_url = x.get('URL')
+            elif description == 'All Offers' and self.all_offers_url is None:
+                self.all_offers_url = x.get('URL')
 
 
 class Offers:
@@ -319,13 +400,13 @@ class Offers:
         self._offers = offers
         self.total_offers = self._offers.get('TotalOffers')
         self.more_offers_url = self._offers.get('MoreOffersUrl') if self._offers.get('MoreOffersUrl') != '0' else None
-        self.condition = self._offers.get('Offer', {}).get('OfferAttributes', {}).get('Condition')
-        self.buy_box_price = self._offers.get('Offer', {}).get('OfferListing', {}).get('Price', {}).get('Amount')
-        self.buy_box_price = int(self.buy_box_price) if isinstance(self.buy_box_price, str) else None
-        self.super_saver_shipping = self._offers.get('Offer', {}).get('OfferListing', {}).get('IsEligibleForSuperSaverShipping')
-        self.prime_shipping = self._offers.get('Offer', {}).get('OfferListing', {}).get('IsEligibleForPrime')
-        self.super_saver_shipping = True if self.super_saver_shipping == '1' else False
-        self.prime_shipping = True if self.prime_shipping == '1' else False
+        offer = self._offers.get('Offer', {})
+        offer_listing = offer.get('OfferListing', {})
+        self.condition = offer.get('OfferAttributes', {}).get('Condition')
+        price = offer_listing.get('Price', {}).get('Amount')
+        self.buy_box_price = int(price) if isinstance(price, str) else None
+        self.super_saver_shipping = offer_listing.get('IsEligibleForSuperSaverShipping') == '1'
+        self.prime_shipping = offer_listing.get('IsEligibleForPrime') == '1'
 
 
 class OfferSummary: